@@ -1,15 +1,28 @@
 import os
+import re
 import time
 import uuid
-from functools import wraps
+from functools import lru_cache, wraps
+from concurrent.futures import ThreadPoolExecutor
 import io
 from urllib.request import urlopen
+from urllib.parse import unquote
 from datetime import datetime, timedelta
 import json
-
+import hashlib
+import itertools
+import threading
+from tempfile import SpooledTemporaryFile
+
+import click
+from cachetools import TTLCache
+import orjson
 import firebase_admin
 from firebase_admin import auth, credentials, firestore, storage
-from flask import Flask, jsonify, render_template, request, send_file, make_response
+from flask import Flask, Request, jsonify, render_template, request, send_from_directory, make_response
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import quote_etag
 
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Image
@@ -17,6 +30,7 @@ from reportlab.lib import colors
 from reportlab.lib.styles import getSampleStyleSheet
 from PIL import Image as PILImage
 from google.cloud.firestore_v1.base_query import FieldFilter
+from google.api_core.exceptions import AlreadyExists
 
 # --- Firebase Initialization ---
 cred_path = os.path.join(os.path.dirname(__file__), 'firebase_credentials.json')
@@ -27,9 +41,88 @@ firebase_admin.initialize_app(cred, {
 db = firestore.client()
 bucket = storage.bucket()
 
+# --- Firestore References ---
+# Per-user paths are rebuilt on every request otherwise; the references are immutable, so share them.
+@lru_cache(maxsize=1024)
+def user_doc(uid):
+    return db.collection('users').document(uid)
+
+@lru_cache(maxsize=1024)
+def user_products(uid):
+    return user_doc(uid).collection('products')
+
+@lru_cache(maxsize=1024)
+def user_sales(uid):
+    return user_doc(uid).collection('sales')
+
+@lru_cache(maxsize=1024)
+def user_aggregates(uid):
+    return user_doc(uid).collection('aggregates')
+
+@lru_cache(maxsize=1024)
+def user_product_types(uid):
+    return user_doc(uid).collection('product_types')
+
+@lru_cache(maxsize=1024)
+def user_jobs(uid):
+    return user_doc(uid).collection('jobs')
+
+@lru_cache(maxsize=1024)
+def user_store_settings(uid):
+    return user_doc(uid).collection('settings').document('store')
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+UPLOAD_WORKERS = 8
+PDF_IMAGE_WORKERS = 16
+PDF_ROWS_PER_TABLE = 25
+SALES_DELETE_PAGE_SIZE = 500
+FIRESTORE_BATCH_LIMIT = 500
+SALES_DELETE_BATCH_SIZE = 100
+SALES_DELETE_WORKERS = SALES_DELETE_PAGE_SIZE // SALES_DELETE_BATCH_SIZE
+PDF_JOB_WORKERS = 2
+PDF_URL_EXPIRATION = timedelta(minutes=10)
+PDF_JOB_TIMEOUT = timedelta(minutes=5)
+PDF_IMAGE_TIMEOUT = 10 # seconds; a stuck image host must not pin one of the few PDF job threads
+UPLOAD_SPOOL_SIZE = 256 * 1024
+UPLOAD_CHUNK_SIZE = 2 * 1024 * 1024 # GCS requires a multiple of 256 KB
+MAX_UPLOAD_SIZE = 32 * 1024 * 1024
+STORE_CACHE_CONTROL = 'public, max-age=60, must-revalidate'
+
+class UploadRequest(Request):
+    """Keeps at most UPLOAD_SPOOL_SIZE of each posted file in memory before spilling to disk."""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE, mode='rb+')
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Serializes responses with orjson, falling back to Flask's encoder for types orjson doesn't know."""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+app.request_class = UploadRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE
 
 # --- Authentication Decorator ---
+# Verified ID tokens map to (exp, uid) so repeat requests skip signature verification
+_token_cache = TTLCache(maxsize=10_000, ttl=300)
+_token_cache_lock = threading.Lock()
+
+def verify_token_cached(id_token):
+    """Returns the uid for `id_token`, verifying it with Firebase only on a cache miss."""
+    with _token_cache_lock:
+        cached = _token_cache.get(id_token)
+    if cached and time.time() < cached[0]:
+        return cached[1]
+    decoded_token = auth.verify_id_token(id_token, check_revoked=False)
+    with _token_cache_lock:
+        _token_cache[id_token] = (decoded_token['exp'], decoded_token['uid'])
+    return decoded_token['uid']
+
 def require_auth(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -37,13 +130,16 @@ def require_auth(f):
         if not id_token:
             return jsonify({"success": False, "message": "Authorization token required."}), 401
         try:
-            decoded_token = auth.verify_id_token(id_token)
-            request.user_id = decoded_token['uid']
+            request.user_id = verify_token_cached(id_token)
         except Exception as e:
             return jsonify({"success": False, "message": f"Invalid token: {e}"}), 401
         return f(*args, **kwargs)
     return decorated_function
 
+def get_page_limit():
+    """Reads the `limit` query param, clamped to MAX_PAGE_SIZE."""
+    return max(1, min(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE))
+
 # --- Frontend Route ---
 @app.route('/')
 def index():
@@ -56,7 +152,7 @@ def get_store_settings():
     """Fetches store settings for the authenticated user."""
     try:
         uid = request.user_id
-        settings_ref = db.collection('users').document(uid).collection('settings').document('store')
+        settings_ref = user_store_settings(uid)
         settings_doc = settings_ref.get()
         if settings_doc.exists:
             return jsonify({"success": True, "settings": settings_doc.to_dict()})
@@ -70,34 +166,86 @@ def update_store_settings():
     """Updates store settings for the authenticated user."""
     try:
         uid = request.user_id
-        data = request.json
-        settings_ref = db.collection('users').document(uid).collection('settings').document('store')
+        data = orjson.loads(request.get_data())
+        settings_ref = user_store_settings(uid)
+        data['store_version'] = firestore.Increment(1)
         settings_ref.set(data, merge=True)
         return jsonify({"success": True, "message": "Store information updated successfully."})
     except Exception as e:
         return jsonify({"success": False, "message": f"Error updating settings: {e}"}), 500
 
 # --- Public Storefront Endpoints ---
+def bump_store_version(uid):
+    """Invalidates the public storefront ETag after the catalog changes."""
+    settings_ref = user_store_settings(uid)
+    settings_ref.set({'store_version': firestore.Increment(1)}, merge=True)
+
+def store_etag(user_id, response_data):
+    """Builds the (unquoted) storefront ETag from the store version, or a content hash if there is none yet."""
+    store_version = response_data['settings'].get('store_version')
+    if store_version is not None:
+        return f'{user_id}-{store_version}'
+    return hashlib.sha1(json.dumps(response_data, sort_keys=True, default=str).encode()).hexdigest()
+
+def store_not_modified(etag):
+    """A 304 carrying the same validators and caching policy as the full response."""
+    return ('', 304, {'ETag': quote_etag(etag), 'Cache-Control': STORE_CACHE_CONTROL})
+
+def start_stream(query):
+    """Starts streaming `query` and returns an iterator over its docs with the first one already fetched."""
+    docs = query.stream()
+    first_doc = next(docs, None)
+    return itertools.chain([first_doc], docs) if first_doc is not None else iter(())
+
+def stream_store_json(settings_data, product_docs):
+    """Yields the storefront response one product at a time instead of building the whole body."""
+    yield b'{"success":true,"settings":' + orjson.dumps(settings_data, default=app.json.default) + b',"products":['
+    for index, doc in enumerate(product_docs):
+        if index:
+            yield b','
+        yield orjson.dumps(doc.to_dict(), default=app.json.default)
+    yield b']}'
+
 @app.route('/api/store/<user_id>', methods=['GET'])
 def get_store_products(user_id):
     """
     Public endpoint to fetch all products and store settings for a given user.
+    Answers 304 when the client's If-None-Match matches the current store version,
+    so only the small settings doc is read on a cache hit.
     """
     try:
-        settings_ref = db.collection('users').document(user_id).collection('settings').document('store')
-        settings_doc = settings_ref.get()
-        settings_data = settings_doc.to_dict() if settings_doc.exists else {}
-        
-        products_query = db.collection('users').document(user_id).collection('products').order_by('item_number')
-        all_docs = products_query.stream()
-        products = [doc.to_dict() for doc in all_docs]
-        
-        response_data = { "success": True, "settings": settings_data, "products": products }
+        settings_ref = user_store_settings(user_id)
+        products_query = user_products(user_id).order_by('item_number')
+        # Parsed so weak (W/"...") and comma-separated validators from proxies/CDNs still match
+        if_none_match = request.if_none_match
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            # A revalidating client is likely to get a 304, so it reads settings first;
+            # anyone else needs both reads, so they run concurrently
+            products_future = None if if_none_match else executor.submit(start_stream, products_query)
+            settings_doc = settings_ref.get()
+            settings_data = settings_doc.to_dict() if settings_doc.exists else {}
+
+            if if_none_match and settings_data.get('store_version') is not None:
+                etag = store_etag(user_id, {"settings": settings_data})
+                if if_none_match.contains_weak(etag):
+                    return store_not_modified(etag)
+
+            product_docs = products_future.result() if products_future else products_query.stream()
+
+        if settings_data.get('store_version') is not None:
+            # The ETag doesn't depend on the body, so products go out as they arrive from Firestore
+            etag = store_etag(user_id, {"settings": settings_data})
+            response = app.response_class(stream_store_json(settings_data, product_docs), mimetype='application/json')
+        else:
+            response_data = { "success": True, "settings": settings_data, "products": [doc.to_dict() for doc in product_docs] }
+            etag = store_etag(user_id, response_data)
+            if if_none_match.contains_weak(etag):
+                return store_not_modified(etag)
+            response = make_response(jsonify(response_data))
         
-        response = make_response(jsonify(response_data))
-        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-        response.headers['Pragma'] = 'no-cache'
-        response.headers['Expires'] = '0'
+        response.headers['ETag'] = quote_etag(etag)
+        response.headers['Cache-Control'] = STORE_CACHE_CONTROL
         
         return response
     except Exception as e:
@@ -109,33 +257,79 @@ def get_store_products(user_id):
 def serve_store_page(user_id):
     """
     Serves the static HTML page for the customer storefront.
+    The page has no template context, so it is sent as a file with Werkzeug's
+    ETag/Last-Modified handling and cached by the browser for an hour.
+    """
+    return send_from_directory(app.template_folder, 'store.html', max_age=3600)
+
+# --- Storage Helpers ---
+def storage_blob_name(url):
+    """Extracts the blob name from a Firebase download URL or a GCS public URL, else None."""
+    if "firebasestorage.googleapis.com" in url:
+        return unquote(url[url.find("/o/") + 3:url.find("?alt=media")])
+    public_prefix = f"https://storage.googleapis.com/{bucket.name}/"
+    if url.startswith(public_prefix):
+        return unquote(url[len(public_prefix):])
+    return None
+
+def owned_blob_name(uid, url):
+    """Returns the blob name behind `url` if it is one of `uid`'s product images, else None."""
+    blob_name = storage_blob_name(url)
+    return blob_name if blob_name and blob_name.startswith(f"products/{uid}/") else None
+
+def delete_storage_files(uid, urls):
     """
-    return render_template('store.html')
+    Deletes `uid`'s product images behind `urls` in a single batch request; URLs outside the
+    user's own prefix are skipped, missing files are ignored and other failures logged.
+    """
+    blob_names = [name for name in (owned_blob_name(uid, url) for url in urls) if name]
+    if not blob_names:
+        return
+    try:
+        with bucket.client.batch(raise_exception=False) as batch:
+            bucket.delete_blobs(blob_names)
+        # Failures only show up in the batch's sub-responses; a 404 just means the file is already gone
+        for blob_name, response in zip(blob_names, batch._responses):
+            if not 200 <= response.status_code < 300 and response.status_code != 404:
+                app.logger.error(f"Could not delete file {blob_name}: {response.status_code} {response.text}")
+    except Exception as e:
+        app.logger.error(f"Could not delete files {blob_names}: {e}") # Log error but continue
+
+def upload_product_image(uid, item_number, image):
+    """Uploads one product image and returns its public URL."""
+    blob = bucket.blob(f"products/{uid}/{item_number}_{uuid.uuid4()}")
+    # A chunk size switches to a resumable upload that reads the file one chunk at a time. Each chunk is
+    # a round-trip, so chunks are large enough that a typical photo takes one or two, at the cost of
+    # buffering up to one chunk per concurrent upload
+    blob.chunk_size = UPLOAD_CHUNK_SIZE
+    blob.upload_from_file(image.stream, content_type=image.content_type)
+    blob.make_public()
+    return blob.public_url
 
 # --- Product API Endpoints ---
 @app.route('/api/products', methods=['GET'])
 @require_auth
 def get_products():
+    """
+    Returns one page of products ordered by item number.
+    `start_after` is the `next_cursor` (last item number) of the previous page.
+    """
     try:
         uid = request.user_id
-        products_query = db.collection('users').document(uid).collection('products').order_by('item_number')
+        products_query = user_products(uid).order_by('item_number')
         
-        limit_str = request.args.get('limit')
-        if limit_str:
-            limit = int(limit_str)
-            start_after = request.args.get('start_after', None)
-            if start_after:
-                start_doc = db.collection('users').document(uid).collection('products').document(start_after).get()
-                products_query = products_query.start_after(start_doc)
-            
-            products_docs = products_query.limit(limit).stream()
-            products = [doc.to_dict() for doc in products_docs]
-            has_next = len(products) == limit
-            return jsonify({ "products": products, "has_next": has_next })
-        else:
-            all_docs = products_query.stream()
-            products = [doc.to_dict() for doc in all_docs]
-            return jsonify({ "products": products, "has_next": False })
+        try:
+            limit = get_page_limit()
+        except ValueError:
+            return jsonify({"success": False, "message": "Invalid paging parameters."}), 400
+        start_after = request.args.get('start_after', None)
+        if start_after:
+            products_query = products_query.start_after({'item_number': start_after})
+        
+        products_docs = products_query.limit(limit).stream()
+        products = [doc.to_dict() for doc in products_docs]
+        next_cursor = products[-1]['item_number'] if len(products) == limit else None
+        return jsonify({ "products": products, "next_cursor": next_cursor })
     except Exception as e:
         return jsonify({"success": False, "message": f"Error getting products: {e}"}), 500
 
@@ -151,12 +345,14 @@ def add_update_product():
         item_number = product_data.get('item_number', '').upper()
         if not item_number: return jsonify({"success": False, "message": "Item Number is required."}), 400
         
-        product_ref = db.collection('users').document(uid).collection('products').document(item_number)
+        product_ref = user_products(uid).document(item_number)
         
         # --- NEW: MULTI-IMAGE HANDLING LOGIC ---
         
         # 1. Get existing image URLs from form (images user wants to keep)
         existing_urls_to_keep = json.loads(request.form.get('existing_image_urls', '[]'))
+        if not all(isinstance(url, str) and owned_blob_name(uid, url) for url in existing_urls_to_keep):
+            return jsonify({"success": False, "message": "Existing images must be your own uploaded product images."}), 400
         
         # 2. Get image URLs currently in the database to compare
         existing_product_doc = product_ref.get()
@@ -165,31 +361,17 @@ def add_update_product():
             urls_in_db = existing_product_doc.to_dict().get('image_urls', [])
 
         # 3. Determine which images were removed by the user and delete from storage
-        urls_to_delete = [url for url in urls_in_db if url not in existing_urls_to_keep]
-        for url in urls_to_delete:
-            try:
-                # This logic extracts the file path from the public URL to delete it from storage
-                if "firebasestorage.googleapis.com" in url:
-                    start = url.find("/o/") + 3
-                    end = url.find("?alt=media")
-                    filename = unquote(url[start:end])
-                    blob = bucket.blob(filename)
-                    if blob.exists():
-                        blob.delete()
-            except Exception as e:
-                app.logger.error(f"Could not delete file for URL {url}: {e}") # Log error but continue
+        urls_to_delete = set(urls_in_db) - set(existing_urls_to_keep)
+        delete_storage_files(uid, urls_to_delete)
 
         # 4. Upload any new images
         newly_uploaded_urls = []
-        if 'images' in request.files:
-            images = request.files.getlist('images')
-            for image in images:
-                if image.filename != '':
-                    filename = f"products/{uid}/{item_number}_{uuid.uuid4()}"
-                    blob = bucket.blob(filename)
-                    blob.upload_from_file(image, content_type=image.content_type)
-                    blob.make_public()
-                    newly_uploaded_urls.append(blob.public_url)
+        images = [image for image in request.files.getlist('images') if image.filename != '']
+        if images:
+            # Uploads are independent network round-trips, so overlap them
+            with ThreadPoolExecutor(max_workers=min(UPLOAD_WORKERS, len(images))) as executor:
+                futures = [executor.submit(upload_product_image, uid, item_number, image) for image in images]
+                newly_uploaded_urls = [future.result() for future in futures]
         
         # 5. Combine kept and new URLs for the final list
         final_image_urls = existing_urls_to_keep + newly_uploaded_urls
@@ -202,7 +384,10 @@ def add_update_product():
 
         product_data['item_number'] = item_number
         product_ref.set(product_data, merge=True)
+        bump_store_version(uid)
         return jsonify({"success": True, "message": "Product saved successfully."})
+    except RequestEntityTooLarge:
+        return jsonify({"success": False, "message": f"Upload is too large; the limit is {MAX_UPLOAD_SIZE // (1024 * 1024)} MB per request."}), 413
     except Exception as e:
         app.logger.error(f"Error saving product: {e}")
         return jsonify({"success": False, "message": f"Error saving product: {e}"}), 500
@@ -215,47 +400,116 @@ def delete_product(item_number):
         uid = request.user_id
         item_number_upper = item_number.upper()
         
-        product_ref = db.collection('users').document(uid).collection('products').document(item_number_upper)
+        product_ref = user_products(uid).document(item_number_upper)
         product_doc = product_ref.get()
         
         if product_doc.exists:
             # Delete associated images from storage
-            image_urls = product_doc.to_dict().get('image_urls', [])
-            for url in image_urls:
-                try:
-                    if "firebasestorage.googleapis.com" in url:
-                        start = url.find("/o/") + 3
-                        end = url.find("?alt=media")
-                        filename = unquote(url[start:end])
-                        blob = bucket.blob(filename)
-                        if blob.exists():
-                            blob.delete()
-                except Exception as e:
-                    app.logger.error(f"Could not delete file for product {item_number_upper}: {e}")
-
-        # Transaction to delete product and sales records
-        transaction = db.transaction()
-        @firestore.transactional
-        def delete_product_and_sales_transaction(transaction):
-            sales_query = db.collection('users').document(uid).collection('sales').where(filter=FieldFilter('items', 'array_contains', {'item_number': item_number_upper}))
-            sales_docs = sales_query.stream(transaction=transaction)
-            for sale in sales_docs:
-                transaction.delete(sale.reference)
-            transaction.delete(product_ref)
+            delete_storage_files(uid, product_doc.to_dict().get('image_urls', []))
 
-        delete_product_and_sales_transaction(transaction)
+        def delete_sales_and_reverse(sales_docs):
+            # The deletes and their summed aggregate decrements commit together, so a failure leaves both
+            # for a retry; the precondition keeps a sale deleted concurrently from being subtracted twice
+            batch = db.batch()
+            for sale in sales_docs:
+                batch.delete(sale.reference, option=db.write_option(last_update_time=sale.update_time))
+            reverse_sales_aggregates(batch, uid, [sale.to_dict() for sale in sales_docs])
+            batch.commit()
+
+        # Page through the product's sales and commit each page as a few parallel sub-batches. That has no
+        # size limit, and each sub-batch writes every aggregate doc once rather than once per sale
+        sales_query = user_sales(uid).where(filter=FieldFilter('item_numbers', 'array_contains', item_number_upper)).limit(SALES_DELETE_PAGE_SIZE)
+        with ThreadPoolExecutor(max_workers=SALES_DELETE_WORKERS) as executor:
+            while True:
+                sales_docs = list(sales_query.stream())
+                if not sales_docs:
+                    break
+                sub_batches = [sales_docs[start:start + SALES_DELETE_BATCH_SIZE] for start in range(0, len(sales_docs), SALES_DELETE_BATCH_SIZE)]
+                list(executor.map(delete_sales_and_reverse, sub_batches))
+
+        # The product goes last so a failed cleanup can be retried
+        product_ref.delete()
+        bump_store_version(uid)
         
         return jsonify({"success": True, "message": "Product and associated sales deleted."})
     except Exception as e:
         return jsonify({"success": False, "message": f"Error deleting product: {e}"}), 500
 
 # --- Sales API Endpoints ---
+def sales_aggregate_refs(uid, timestamp):
+    """Returns the all-time, monthly and daily aggregate docs a sale at `timestamp` counts toward."""
+    sale_dt = datetime.fromtimestamp(timestamp)
+    aggregates_ref = user_aggregates(uid)
+    return [aggregates_ref.document('all'), aggregates_ref.document(sale_dt.strftime('%Y-%m')), aggregates_ref.document(sale_dt.strftime('%Y-%m-%d'))]
+
+def legacy_sale_profit(sale_data):
+    """Recomputes the profit of a sale recorded before `total_profit` was stored, from its items."""
+    return sum((float(item.get('selling_price', 0)) - float(item.get('import_price', 0))) * int(item.get('quantity', 0)) for item in sale_data.get('items', []))
+
+def reverse_sales_aggregates(writer, uid, sales):
+    """Subtracts the given sales from their aggregate docs using `writer` (a transaction or batch)."""
+    deltas = {}
+    for sale_data in sales:
+        # Only sales carrying `total_profit` were ever added to the aggregates (record_sale or the backfill)
+        if 'timestamp' not in sale_data or 'total_profit' not in sale_data:
+            continue
+        for aggregate_ref in sales_aggregate_refs(uid, sale_data['timestamp']):
+            totals = deltas.setdefault(aggregate_ref.id, {'ref': aggregate_ref, 'profit': 0, 'revenue': 0})
+            totals['profit'] += float(sale_data['total_profit'])
+            totals['revenue'] += float(sale_data.get('total_amount', 0))
+    for totals in deltas.values():
+        writer.set(totals['ref'], {'profit': firestore.Increment(-totals['profit']), 'revenue': firestore.Increment(-totals['revenue'])}, merge=True)
+
+def commit_in_batches(writes):
+    """Applies (method, ref, *args) writes in batches of at most FIRESTORE_BATCH_LIMIT."""
+    for chunk_start in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for method, *args in writes[chunk_start:chunk_start + FIRESTORE_BATCH_LIMIT]:
+            getattr(batch, method)(*args)
+        batch.commit()
+
+@app.cli.command('backfill-sales-aggregates')
+def backfill_sales_aggregates():
+    """
+    One-off migration for sales recorded before aggregates existed: stores `total_profit`
+    and `item_numbers` on every sale lacking them, then rewrites each user's aggregate docs
+    from their sales. Run it with the app stopped so no sale lands mid-rebuild.
+    """
+    for user_ref in db.collection('users').list_documents():
+        uid = user_ref.id
+        totals = {}
+        sale_writes = []
+        for sale in user_sales(uid).stream():
+            sale_data = sale.to_dict()
+            updates = {}
+            if 'total_profit' not in sale_data:
+                updates['total_profit'] = legacy_sale_profit(sale_data)
+            if 'item_numbers' not in sale_data:
+                updates['item_numbers'] = list(dict.fromkeys(item['item_number'].upper() for item in sale_data.get('items', []) if item.get('item_number')))
+            if updates:
+                sale_writes.append(('update', sale.reference, updates))
+                sale_data.update(updates)
+            if 'timestamp' not in sale_data:
+                continue
+            for aggregate_ref in sales_aggregate_refs(uid, sale_data['timestamp']):
+                period_totals = totals.setdefault(aggregate_ref.id, {'ref': aggregate_ref, 'profit': 0, 'revenue': 0})
+                period_totals['profit'] += float(sale_data['total_profit'])
+                period_totals['revenue'] += float(sale_data.get('total_amount', 0))
+        commit_in_batches(sale_writes)
+
+        # Overwrite rather than increment, and drop docs for periods that no longer have sales
+        aggregate_writes = [('delete', aggregate_ref) for aggregate_ref in user_aggregates(uid).list_documents() if aggregate_ref.id not in totals]
+        aggregate_writes += [('set', period_totals['ref'], {'profit': period_totals['profit'], 'revenue': period_totals['revenue']}) for period_totals in totals.values()]
+        commit_in_batches(aggregate_writes)
+        click.echo(f"Backfilled {len(sale_writes)} sales and {len(totals)} aggregate docs for user {uid}")
+
 @app.route('/api/sales', methods=['GET'])
 @require_auth
 def get_sales():
     try:
         uid = request.user_id
-        sales_query = db.collection('users').document(uid).collection('sales')
+        sales_query = user_sales(uid)
+        period_key = 'all'
         
         date_filter = request.args.get('date')
         month_filter = request.args.get('month')
@@ -263,29 +517,38 @@ def get_sales():
         if date_filter:
             start_dt = datetime.strptime(date_filter, '%Y-%m-%d')
             end_dt = start_dt + timedelta(days=1)
+            period_key = start_dt.strftime('%Y-%m-%d')
             sales_query = sales_query.where(filter=FieldFilter('timestamp', '>=', start_dt.timestamp())).where(filter=FieldFilter('timestamp', '<', end_dt.timestamp()))
         elif month_filter:
             start_dt = datetime.strptime(month_filter, '%Y-%m')
             next_month_start_year = start_dt.year + 1 if start_dt.month == 12 else start_dt.year
             next_month_start_month = 1 if start_dt.month == 12 else start_dt.month + 1
             end_dt = datetime(next_month_start_year, next_month_start_month, 1)
+            period_key = start_dt.strftime('%Y-%m')
             sales_query = sales_query.where(filter=FieldFilter('timestamp', '>=', start_dt.timestamp())).where(filter=FieldFilter('timestamp', '<', end_dt.timestamp()))
 
-        sales_ref = sales_query.order_by('timestamp', direction=firestore.Query.DESCENDING).stream()
+        page_query = sales_query.order_by('timestamp', direction=firestore.Query.DESCENDING)
+        try:
+            limit = get_page_limit()
+            start_after = request.args.get('start_after', None)
+            if start_after:
+                page_query = page_query.start_after({'timestamp': float(start_after)})
+        except ValueError:
+            return jsonify({"success": False, "message": "Invalid paging parameters."}), 400
         
         sales_list = []
-        total_profit = 0
-        
-        for sale in sales_ref:
+        for sale in page_query.limit(limit).stream():
             sale_data = sale.to_dict()
             sale_data['id'] = sale.id
             sales_list.append(sale_data)
-            
-            for item in sale_data.get('items', []):
-                profit_per_item = float(item.get('selling_price', 0)) - float(item.get('import_price', 0))
-                total_profit += profit_per_item * int(item.get('quantity', 0))
+        next_cursor = sales_list[-1]['timestamp'] if len(sales_list) == limit else None
+
+        # Totals come from the aggregate doc maintained by record_sale/delete_sale, not the page;
+        # a period without one has no sales
+        aggregate_doc = user_aggregates(uid).document(period_key).get()
+        aggregate = aggregate_doc.to_dict() if aggregate_doc.exists else {}
 
-        return jsonify({"sales": sales_list, "total_profit": total_profit})
+        return jsonify({"sales": sales_list, "next_cursor": next_cursor, "total_profit": aggregate.get('profit', 0), "total_sales": aggregate.get('revenue', 0)})
 
     except Exception as e:
         return jsonify({"success": False, "message": f"Error getting sales: {e}"}), 500
@@ -295,44 +558,64 @@ def get_sales():
 def record_sale():
     try:
         uid = request.user_id
-        sale_items = request.json.get('items', [])
+        sale_items = orjson.loads(request.get_data()).get('items', [])
         if not sale_items:
             return jsonify({"success": False, "message": "Sale must contain at least one item."}), 400
 
+        # Only item numbers and quantities are taken from the client; prices come from the product docs
+        quantities = {}
+        for item in sale_items:
+            item_number = item.get('item_number', '').upper()
+            quantities[item_number] = quantities.get(item_number, 0) + int(item.get('quantity', 0))
+        if any(quantity <= 0 for quantity in quantities.values()):
+            return jsonify({"success": False, "message": "Each item must have a positive quantity."}), 400
+
         transaction = db.transaction()
         @firestore.transactional
-        def update_in_transaction(transaction, sale_items_payload):
-            product_refs_to_update = {}
+        def update_in_transaction(transaction, quantities_sold):
+            # Read every product in one round-trip instead of one get() per item
+            products_ref = user_products(uid)
+            snapshots = {snapshot.id: snapshot for snapshot in transaction.get_all([products_ref.document(item_number) for item_number in quantities_sold])}
             
-            for item in sale_items_payload:
-                item_number = item.get('item_number', '').upper()
-                product_ref = db.collection('users').document(uid).collection('products').document(item_number)
-                snapshot = product_ref.get(transaction=transaction)
-                if not snapshot.exists:
+            sale_items_data = []
+            total_sale_amount = 0
+            total_profit = 0
+            for item_number, quantity_sold in quantities_sold.items():
+                snapshot = snapshots.get(item_number)
+                if snapshot is None or not snapshot.exists:
                     raise ValueError(f"Product {item_number} not found.")
                 
                 product_data = snapshot.to_dict()
                 current_quantity = int(product_data.get('quantity', 0))
-                quantity_sold = int(item.get('quantity', 0))
                 if current_quantity < quantity_sold:
                     raise ValueError(f"Not enough stock for {product_data.get('item_name')}.")
                 
-                new_quantity = current_quantity - quantity_sold
-                product_refs_to_update[item_number] = (product_ref, new_quantity)
-                item['import_price'] = float(product_data.get('import_price', 0))
-
-            total_sale_amount = 0
-            for item in sale_items_payload:
-                item_number = item.get('item_number').upper()
-                product_ref, new_quantity = product_refs_to_update[item_number]
-                transaction.update(product_ref, {'quantity': new_quantity})
-                total_sale_amount += float(item.get('selling_price')) * int(item.get('quantity'))
+                selling_price = float(product_data.get('selling_price', 0))
+                import_price = float(product_data.get('import_price', 0))
+                line_total = selling_price * quantity_sold
+                line_profit = (selling_price - import_price) * quantity_sold
+                transaction.update(snapshot.reference, {'quantity': current_quantity - quantity_sold})
+                sale_items_data.append({
+                    'item_number': item_number,
+                    'item_name': product_data.get('item_name', ''),
+                    'quantity': quantity_sold,
+                    'selling_price': selling_price,
+                    'import_price': import_price,
+                    'line_total': line_total,
+                    'profit': line_profit
+                })
+                total_sale_amount += line_total
+                total_profit += line_profit
             
-            sale_ref = db.collection('users').document(uid).collection('sales').document()
-            sale_data = { "items": sale_items_payload, "total_amount": total_sale_amount, "timestamp": time.time() }
+            sale_ref = user_sales(uid).document()
+            sale_data = { "items": sale_items_data, "item_numbers": list(quantities_sold), "total_amount": total_sale_amount, "total_profit": total_profit, "timestamp": time.time() }
             transaction.set(sale_ref, sale_data)
 
-        update_in_transaction(transaction, sale_items)
+            totals = {'profit': firestore.Increment(total_profit), 'revenue': firestore.Increment(total_sale_amount)}
+            for aggregate_ref in sales_aggregate_refs(uid, sale_data['timestamp']):
+                transaction.set(aggregate_ref, totals, merge=True)
+
+        update_in_transaction(transaction, quantities)
         
         return jsonify({"success": True, "message": "Sale recorded successfully!"})
     except ValueError as e:
@@ -345,7 +628,7 @@ def record_sale():
 def delete_sale(sale_id):
     try:
         uid = request.user_id
-        sale_ref = db.collection('users').document(uid).collection('sales').document(sale_id)
+        sale_ref = user_sales(uid).document(sale_id)
 
         transaction = db.transaction()
         @firestore.transactional
@@ -358,8 +641,10 @@ def delete_sale(sale_id):
                 item_number = item.get('item_number')
                 quantity_restored = int(item.get('quantity', 0))
                 if item_number and quantity_restored > 0:
-                    product_ref = db.collection('users').document(uid).collection('products').document(item_number)
+                    product_ref = user_products(uid).document(item_number)
                     transaction.update(product_ref, {'quantity': firestore.Increment(quantity_restored)})
+
+            reverse_sales_aggregates(transaction, uid, [sale_data])
             
             transaction.delete(sale_ref)
         
@@ -371,67 +656,176 @@ def delete_sale(sale_id):
         return jsonify({"success": False, "message": f"An unexpected error occurred: {e}"}), 500
 
 # --- PDF Generation Endpoint ---
+# Styles don't depend on the report's data, so build them once rather than per PDF
+PDF_STYLES = getSampleStyleSheet()
+STOCK_TABLE_HEADER = ["Image", "Item #", "Name", "Qty", "Import Price", "Selling Price"]
+STOCK_TABLE_COL_WIDTHS = [60, 80, 140, 40, 80, 80]
+STOCK_TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.grey), ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'), ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'), ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('BACKGROUND', (0, 1), (-1, -1), colors.beige), ('GRID', (0, 0), (-1, -1), 1, colors.black)
+])
+
 def get_image_for_pdf(url, width=50):
+    """Downloads an image once and embeds it as a JPEG thumbnail sized for the table cell."""
     if not url: return "N/A"
     try:
-        f = urlopen(url)
-        img = PILImage.open(f)
+        with urlopen(url, timeout=PDF_IMAGE_TIMEOUT) as f:
+            img = PILImage.open(io.BytesIO(f.read()))
         aspect = img.height / float(img.width)
-        return Image(urlopen(url), width=width, height=width * aspect)
+        # PDF units are 72 DPI points, so `width` pixels is all the cell can show
+        img.thumbnail((width, width * 4))
+        if img.mode in ('RGBA', 'LA', 'P'):
+            # JPEG has no alpha, so flatten transparent backgrounds onto white rather than black
+            img = img.convert('RGBA')
+            background = PILImage.new('RGB', img.size, 'white')
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        thumbnail = io.BytesIO()
+        img.convert('RGB').save(thumbnail, format='JPEG')
+        thumbnail.seek(0)
+        return Image(thumbnail, width=width, height=width * aspect)
     except Exception: return "No Image"
 
-@app.route('/api/generate-pdf', methods=['GET'])
-@require_auth
-def generate_stock_pdf():
-    try:
-        uid = request.user_id
-        products_ref = db.collection('users').document(uid).collection('products').order_by('item_number').stream()
-        buffer = io.BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=letter)
-        elements = []
-        styles = getSampleStyleSheet()
-        elements.append(Paragraph("Stock & Inventory Report", styles['h1']))
-        elements.append(Paragraph(f"Report generated on: {time.strftime('%Y-%m-%d %H:%M:%S')}", styles['Normal']))
-        table_data = [["Image", "Item #", "Name", "Qty", "Import Price", "Selling Price"]]
-        
+# Reports are built off the request thread; job state lives in Firestore so any worker can answer polls
+pdf_executor = ThreadPoolExecutor(max_workers=PDF_JOB_WORKERS)
+
+def build_stock_pdf(uid):
+    """Renders the stock report for `uid` and returns it as a BytesIO."""
+    products_ref = user_products(uid).order_by('item_number').stream()
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=letter)
+    elements = []
+    elements.append(Paragraph("Stock & Inventory Report", PDF_STYLES['h1']))
+    elements.append(Paragraph(f"Report generated on: {time.strftime('%Y-%m-%d %H:%M:%S')}", PDF_STYLES['Normal']))
+    table_rows = []
+    
+    # Image downloads start while the remaining products are still streaming in
+    with ThreadPoolExecutor(max_workers=PDF_IMAGE_WORKERS) as executor:
+        image_futures = []
         for p in products_ref:
             product = p.to_dict()
             # Use the first image from the list for the PDF
-            first_image = product.get('image_urls', [None])[0]
-            table_data.append([
-                get_image_for_pdf(first_image),
+            first_image = (product.get('image_urls') or [None])[0]
+            image_futures.append(executor.submit(get_image_for_pdf, first_image))
+            table_rows.append([
                 product.get('item_number', 'N/A'),
                 product.get('item_name', 'N/A'),
                 str(product.get('quantity', 0)),
                 f"${float(product.get('import_price', 0)):.2f}",
                 f"${float(product.get('selling_price', 0)):.2f}"
             ])
-            
-        if len(table_data) > 1:
-            table = Table(table_data, colWidths=[60, 80, 140, 40, 80, 80])
-            table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), colors.grey), ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'), ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'), ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                ('BACKGROUND', (0, 1), (-1, -1), colors.beige), ('GRID', (0, 0), (-1, -1), 1, colors.black)
-            ]))
+        table_rows = [[future.result()] + row for future, row in zip(image_futures, table_rows)]
+        
+    if table_rows:
+        # Several small tables lay out much faster than one unbounded table; a chunk can still
+        # split across pages, so its header repeats on the continuation page
+        for chunk_start in range(0, len(table_rows), PDF_ROWS_PER_TABLE):
+            table = Table([STOCK_TABLE_HEADER] + table_rows[chunk_start:chunk_start + PDF_ROWS_PER_TABLE], colWidths=STOCK_TABLE_COL_WIDTHS, repeatRows=1)
+            table.setStyle(STOCK_TABLE_STYLE)
             elements.append(table)
-        else:
-            elements.append(Paragraph("No products in inventory.", styles['Normal']))
-            
-        doc.build(elements)
-        buffer.seek(0)
-        return send_file(buffer, as_attachment=True, download_name='stock_report.pdf', mimetype='application/pdf')
+    else:
+        elements.append(Paragraph("No products in inventory.", PDF_STYLES['Normal']))
+        
+    doc.build(elements)
+    buffer.seek(0)
+    return buffer
+
+def run_stock_pdf_job(uid, job_id):
+    """Builds the report, uploads it to Storage and records a signed download URL on the job doc."""
+    job_ref = user_jobs(uid).document(job_id)
+    try:
+        blob = bucket.blob(f"reports/{uid}/{job_id}.pdf")
+        blob.upload_from_file(build_stock_pdf(uid), content_type='application/pdf')
+        url = blob.generate_signed_url(version='v4', expiration=PDF_URL_EXPIRATION, response_disposition='attachment; filename=stock_report.pdf')
+        job_ref.update({'status': 'ready', 'url': url})
+    except Exception as e:
+        app.logger.error(f"Error generating PDF for job {job_id}: {e}")
+        job_ref.update({'status': 'error', 'message': f"Error generating PDF: {e}"})
+
+def delete_expired_pdf_jobs(uid):
+    """Removes job docs and report blobs whose download URL can no longer be used."""
+    cutoff = time.time() - (PDF_JOB_TIMEOUT + PDF_URL_EXPIRATION).total_seconds()
+    expired_jobs = list(user_jobs(uid).where(filter=FieldFilter('created_at', '<', cutoff)).stream())
+    if not expired_jobs:
+        return
+    try:
+        with bucket.client.batch(raise_exception=False):
+            bucket.delete_blobs([f"reports/{uid}/{job.id}.pdf" for job in expired_jobs])
+        commit_in_batches([('delete', job.reference) for job in expired_jobs])
+    except Exception as e:
+        app.logger.error(f"Could not delete expired PDF jobs for {uid}: {e}") # Log error but continue
+
+@app.route('/api/generate-pdf', methods=['POST'])
+@require_auth
+def generate_stock_pdf():
+    """Queues a stock report and returns its job id; poll /api/jobs/<job_id> for the download URL."""
+    try:
+        uid = request.user_id
+        job_id = uuid.uuid4().hex
+        user_jobs(uid).document(job_id).set({'type': 'stock_pdf', 'status': 'pending', 'created_at': time.time()})
+        pdf_executor.submit(run_stock_pdf_job, uid, job_id)
+        pdf_executor.submit(delete_expired_pdf_jobs, uid)
+        return jsonify({"success": True, "job_id": job_id}), 202
     except Exception as e:
         return jsonify({"success": False, "message": f"Error generating PDF: {e}"}), 500
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@require_auth
+def get_job(job_id):
+    try:
+        uid = request.user_id
+        job_doc = user_jobs(uid).document(job_id).get()
+        if not job_doc.exists:
+            return jsonify({"success": False, "message": "Job not found."}), 404
+        job = job_doc.to_dict()
+        # Jobs run in-process, so one still pending this long died with its worker
+        if job.get('status') == 'pending' and time.time() - job.get('created_at', 0) > PDF_JOB_TIMEOUT.total_seconds():
+            job.update({'status': 'error', 'message': "PDF generation timed out. Please try again."})
+            job_doc.reference.update({'status': job['status'], 'message': job['message']})
+        return jsonify({"success": True, "job": job})
+    except Exception as e:
+        return jsonify({"success": False, "message": str(e)}), 500
+
 # --- Product Type Endpoints ---
+def product_type_id(type_name):
+    """Derives a type's doc id from its name, so names differing only in case or spacing collide."""
+    return re.sub(r'[\s/.]+', '-', type_name.casefold()).strip('-_')
+
+@app.cli.command('migrate-product-types')
+def migrate_product_types():
+    """
+    One-off migration for types added before name-derived ids: moves each one to its
+    product_type_id() doc, dropping it if that doc already exists, so create() alone
+    catches duplicates.
+    """
+    for user_ref in db.collection('users').list_documents():
+        types_ref = user_product_types(user_ref.id)
+        type_ids = {doc.id for doc in types_ref.list_documents()}
+        moved = dropped = 0
+        for doc in types_ref.stream():
+            type_data = doc.to_dict()
+            type_id = product_type_id(type_data.get('name', '').strip())
+            if not type_id or type_id == doc.id:
+                continue
+            batch = db.batch()
+            if type_id in type_ids:
+                dropped += 1
+            else:
+                batch.create(types_ref.document(type_id), type_data)
+                type_ids.add(type_id)
+                moved += 1
+            batch.delete(doc.reference)
+            batch.commit()
+        click.echo(f"Moved {moved} and dropped {dropped} duplicate product types for user {user_ref.id}")
+
 @app.route('/api/types', methods=['GET'])
 @require_auth
 def get_types():
     try:
         uid = request.user_id
-        types_ref = db.collection('users').document(uid).collection('product_types').stream()
+        types_ref = user_product_types(uid).stream()
         types_list = [{'id': doc.id, **doc.to_dict()} for doc in types_ref]
         return jsonify({"success": True, "types": types_list})
     except Exception as e:
@@ -446,11 +840,14 @@ def add_type():
         if not type_name:
             return jsonify({"success": False, "message": "Type name cannot be empty."}), 400
         
-        existing_types_query = db.collection('users').document(uid).collection('product_types').where(filter=FieldFilter('name', '==', type_name)).limit(1).stream()
-        if len(list(existing_types_query)) > 0:
+        # The doc id is derived from the name, so create() doubles as the duplicate check
+        type_slug = product_type_id(type_name)
+        if not type_slug:
+            return jsonify({"success": False, "message": "Type name is not valid."}), 400
+        try:
+            user_product_types(uid).document(type_slug).create({'name': type_name})
+        except AlreadyExists:
             return jsonify({"success": False, "message": "This product type already exists."}), 409
-
-        db.collection('users').document(uid).collection('product_types').add({'name': type_name})
         return jsonify({"success": True, "message": "Product type added."})
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 500
@@ -460,7 +857,7 @@ def add_type():
 def delete_type(type_id):
     try:
         uid = request.user_id
-        db.collection('users').document(uid).collection('product_types').document(type_id).delete()
+        user_product_types(uid).document(type_id).delete()
         return jsonify({"success": True, "message": "Product type deleted."})
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 500